@@ -1,82 +1,250 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory, send_file
+from flask import Flask, Response, request, jsonify, render_template, send_from_directory
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
-import io
+import re
+import bisect
+import hashlib
+import tempfile
 import zipfile
-from datetime import datetime
+from dataclasses import dataclass
+from datetime import date, datetime
+from functools import lru_cache
 
 app = Flask(__name__)
 
+# 前段に X-Sendfile 対応のサーバ（Apache mod_xsendfile / lighttpd など）がある場合は
+# USE_X_SENDFILE=1 で WAV 本体の送信をそちらに任せる
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
+
 # =====================
 # パス関連
 # =====================
 BASE_DIR   = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploads_raw")   # WAV保存先
+HASH_DIR   = os.path.join(BASE_DIR, "uploads_hash")  # 内容ハッシュ -> 保存済みファイル名
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(HASH_DIR, exist_ok=True)
+
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024  # アップロード1件あたりの上限
+COPY_CHUNK_SIZE  = 64 * 1024         # ストリーム書き出しのチャンクサイズ
+WAV_HEADER_PEEK  = 36                # RIFF ヘッダ(12) + fmt チャンクヘッダ(8) + fmt 本体(16)
+
+# Content-Length なし（chunked）の送信も読み込み中に上限で打ち切る
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+
+# ファイル名: uploaded_YYYYMMDD_HHMMSS.wav（同じ秒に重なったら uploaded_YYYYMMDD_HHMMSS_1.wav …）
+# 年・月・日・時・分・秒をグループで取る
+_FN_RE = re.compile(r"^uploaded_(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})(?:_\d+)?\.wav$")
 
 # =====================
 # ユーティリティ
 # =====================
 
-def save_wav_bytes(data: bytes) -> str:
-    """生バイトを uploaded_YYYYMMDD_HHMMSS.wav として保存してパスを返す。"""
+def is_pcm_wav_header(head: bytes) -> bool:
+    """
+    ボディ先頭が RIFF/WAVE かを確認する。
+    先頭チャンクが fmt なら形式コードも見て、PCM（または WAVE_FORMAT_EXTENSIBLE）以外は弾く。
+    """
+    if len(head) < 12 or head[:4] != b"RIFF" or head[8:12] != b"WAVE":
+        return False
+    if len(head) >= 22 and head[12:16] == b"fmt ":
+        audio_format = int.from_bytes(head[20:22], "little")
+        return audio_format in (1, 0xFFFE)
+    return True
+
+def find_by_hash(digest: str, size: int):
+    """
+    同じ内容で保存済みの WAV があればそのパスを返す。
+    消されている・サイズが違う（別の内容に置き換わっている）場合は None。
+    """
+    try:
+        with open(os.path.join(HASH_DIR, digest), encoding="utf-8") as f:
+            name = f.read().strip()
+        path = os.path.join(UPLOAD_DIR, name)
+        if os.path.getsize(path) != size:
+            return None
+    except OSError:
+        return None
+    return path
+
+def write_hash_marker(digest: str, filename: str):
+    """uploads_hash/<digest> に filename を書く。読み手が書きかけを見ないよう置き換えで書く。"""
+    fd, tmp_path = tempfile.mkstemp(dir=HASH_DIR)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(filename)
+    os.replace(tmp_path, os.path.join(HASH_DIR, digest))
+
+def claim_upload_path(tmp_path: str, stamp: str) -> str:
+    """
+    書き終えた tmp_path を uploaded_<stamp>.wav としてリンクし、そのパスを返す。
+    同名がすでにあれば上書きせず _1, _2 … を付けて空いている名前を取る。
+    """
+    n = 0
+    while True:
+        suffix = f"_{n}" if n else ""
+        save_path = os.path.join(UPLOAD_DIR, f"uploaded_{stamp}{suffix}.wav")
+        try:
+            os.link(tmp_path, save_path)  # 既存の名前なら FileExistsError
+        except FileExistsError:
+            n += 1
+            continue
+        os.unlink(tmp_path)
+        return save_path
+
+def save_wav_stream(stream, head: bytes = b""):
+    """
+    リクエストボディをチャンク単位で uploaded_YYYYMMDD_HHMMSS.wav に書き出してパスを返す。
+    書き込み中はリクエストごとに一意な .part に置き、書き終えてから名前を確保するので、
+    一覧に途中のファイルは出ず、同じ秒に届いた別のアップロードとも混ざらない。
+    head には検査のために先読みした先頭バイトを渡す。
+    ボディが空なら何も残さず None を返す。
+    Wi-Fi 不調による再送で同じ内容が届いた場合は、新しく保存せず既存のパスを返す。
+    """
     now = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"uploaded_{now}.wav"
-    save_path = os.path.join(UPLOAD_DIR, filename)
-    with open(save_path, "wb") as f:
-        f.write(data)
-    print("Saved WAV:", save_path, "size:", len(data))
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".part")
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if head:
+                h.update(head)
+                f.write(head)
+                size += len(head)
+            while True:
+                chunk = stream.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        if size == 0:
+            os.remove(tmp_path)
+            return None
+
+        digest   = h.hexdigest()[:16]
+        existing = find_by_hash(digest, size)
+        if existing:
+            os.remove(tmp_path)
+            print("Duplicate WAV:", existing, "size:", size)
+            return existing
+
+        os.chmod(tmp_path, 0o644)  # mkstemp は 0600 で作るので通常のファイルと揃える
+        save_path = claim_upload_path(tmp_path, now)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    # save_path はこの呼び出しが排他的に確保した名前で、中身は digest を計算したバイトそのもの
+    write_hash_marker(digest, os.path.basename(save_path))
+    print("Saved WAV:", save_path, "size:", size)
     return save_path
 
+class _ZipStream:
+    """
+    ZipFile の書き込み先。書かれたバイトを溜めておき drain() で取り出す。
+    tell/seek を持たないので ZipFile はストリーミングモード（データディスクリプタ付き）で書く。
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+@dataclass(slots=True, frozen=True)
+class Record:
+    """一覧に出す録音1件分。"""
+    filename: str
+    dt: datetime | None  # ファイル名のタイムスタンプ（読めなければ None）
+    text: str = ""       # 将来ローカルSTT結果を埋め込む余地
+
+# load_all_records の結果キャッシュ (mtime, items, dts)
+# uploads_raw の mtime が変わったら作り直す。スレッド間で items と dts が
+# 食い違わないよう、タプルごと1回の代入で差し替える。
+_records_cache = (None, [], [])
+
 def load_all_records():
     """
     uploads_raw 内の WAV を読み込み、
-    ファイル名のタイムスタンプから datetime を作って降順ソートして返す。
+    ファイル名のタイムスタンプから datetime を作って Record のリストを降順ソートして返す。
+    あわせて日時付きレコードの datetime を昇順に並べたリスト（bisect 用）も返す。
+    ディレクトリの mtime が前回と同じならキャッシュを返す。
     """
-    items = []
-    if not os.path.isdir(UPLOAD_DIR):
-        return items
+    global _records_cache
+    try:
+        mtime = os.stat(UPLOAD_DIR).st_mtime_ns
+    except OSError:
+        return [], []
+    cached_mtime, cached_items, cached_dts = _records_cache
+    if cached_mtime == mtime:
+        return cached_items, cached_dts
 
-    for name in sorted(os.listdir(UPLOAD_DIR)):
-        if not name.endswith(".wav"):
-            continue
-        path = os.path.join(UPLOAD_DIR, name)
-        if not os.path.isfile(path):
-            continue
+    # scandir はエントリ種別を持っているので isfile() のための stat が要らない
+    with os.scandir(UPLOAD_DIR) as it:
+        names = sorted(e.name for e in it if e.name.endswith(".wav") and e.is_file())
 
-        # ファイル名: uploaded_YYYYMMDD_HHMMSS.wav
+    items = []
+    for name in names:
+        # strptime は遅いので正規表現1回でタイムスタンプを取り出して組み立てる
         dt = None
-        try:
-            base = os.path.splitext(name)[0]  # uploaded_YYYYMMDD_HHMMSS
-            ts   = base.replace("uploaded_", "")
-            dt   = datetime.strptime(ts, "%Y%m%d_%H%M%S")
-        except Exception:
-            dt = None
-
-        items.append({
-            "filename": name,
-            "datetime": dt.isoformat() if dt else "",
-            "_dt": dt,
-            "text": "",  # 将来ローカルSTT結果を埋め込む余地
-        })
+        m = _FN_RE.match(name)
+        if m:
+            try:
+                dt = datetime(*map(int, m.groups()))
+            except ValueError:
+                dt = None
+
+        items.append(Record(filename=name, dt=dt))
 
     # 日時降順
-    items.sort(key=lambda x: x.get("_dt") or datetime.min, reverse=True)
-    return items
+    items.sort(key=lambda r: r.dt or datetime.min, reverse=True)
+    # 日時なしは末尾に集まるので、日時付きの部分を逆順にすれば昇順になる
+    dts = [r.dt for r in reversed(items) if r.dt is not None]
+
+    _records_cache = (mtime, items, dts)
+    return items, dts
 
-def filter_by_range(items, start_dt, end_dt):
+def filter_by_range(items, dts, start_dt, end_dt):
+    """
+    load_all_records の結果から範囲内のものを降順のまま返す。
+    dts は昇順なので二分探索で境界を求め、items の対応する区間を切り出す。
+    """
     if start_dt is None and end_dt is None:
         return items
-    result = []
-    for it in items:
-        dt = it.get("_dt")
-        if dt is None:
-            continue
-        if start_dt and dt < start_dt:
-            continue
-        if end_dt and dt > end_dt:
-            continue
-        result.append(it)
-    return result
+    n  = len(dts)
+    lo = bisect.bisect_left(dts, start_dt) if start_dt else 0
+    hi = bisect.bisect_right(dts, end_dt) if end_dt else n
+    if lo >= hi:
+        return []
+    # dts[i] は items[n - 1 - i] に対応する
+    return items[n - hi:n - lo]
+
+@lru_cache(maxsize=256)
+def parse_dt(date_str, time_str, is_end=False):
+    """
+    フォームの日付 "YYYY-MM-DD" と時刻 "HH:MM" から datetime を作る。
+    同じ検索条件が繰り返し送られることが多いので結果をメモ化する。
+    """
+    if not date_str:
+        return None
+    if not time_str:
+        time_str = "00:00" if not is_end else "23:59"
+    # "%Y-%m-%d" / "%H:%M" を strptime を使わず分解する
+    try:
+        y, mo, d = date_str.split("-")
+        h, mi    = time_str.split(":")
+        return datetime(int(y), int(mo), int(d), int(h), int(mi))
+    except ValueError:
+        return None
 
 # =====================
 # API: 音声アップロード（保存のみ）
@@ -86,18 +254,36 @@ def filter_by_range(items, start_dt, end_dt):
 def upload_audio():
     print("REQ:", request.method, request.path)
 
-    data = request.data
-    if not data:
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
+        print("Too large:", request.content_length)
+        return jsonify({"status": "error", "message": "too large"}), 413
+
+    # 先頭だけ読んで WAV でなければ保存せずに返す
+    try:
+        head = request.stream.read(WAV_HEADER_PEEK)
+    except RequestEntityTooLarge:
+        return jsonify({"status": "error", "message": "too large"}), 413
+    if not head:
         print("No data in request")
         return jsonify({"status": "error", "message": "no data"}), 400
+    if not is_pcm_wav_header(head):
+        print("Not a PCM WAV:", head[:16])
+        return jsonify({"status": "error", "message": "not a PCM WAV"}), 415
 
-    # 1) WAV保存のみ
+    # 1) WAV保存のみ（ボディはメモリに溜めずそのままファイルへ流す）
     try:
-        wav_path = save_wav_bytes(data)
+        wav_path = save_wav_stream(request.stream, head)
+    except RequestEntityTooLarge:
+        print("Too large while streaming")
+        return jsonify({"status": "error", "message": "too large"}), 413
     except Exception as e:
         print("Error saving wav:", e)
         return jsonify({"status": "error", "message": f"save failed: {e}"}), 500
 
+    if wav_path is None:
+        print("No data in request")
+        return jsonify({"status": "error", "message": "no data"}), 400
+
     # STT は行わない（サーバは軽く保つ）
     return jsonify({
         "status": "ok",
@@ -110,8 +296,12 @@ def upload_audio():
 
 @app.route("/audio/<path:filename>")
 def serve_audio(filename):
-    """uploads_raw 内の WAV をそのまま返す。"""
-    return send_from_directory(UPLOAD_DIR, filename)
+    """
+    uploads_raw 内の WAV をそのまま返す。
+    If-None-Match / If-Modified-Since / Range に応答するので、
+    シークや再読み込みで毎回全体を送らずに済む。
+    """
+    return send_from_directory(UPLOAD_DIR, filename, conditional=True, etag=True)
 
 # =====================
 # 選択した録音を ZIP で一括ダウンロード
@@ -125,19 +315,34 @@ def download_selected():
     if not filenames:
         return jsonify({"status": "error", "message": "no files selected"}), 400
 
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-        for name in filenames:
-            path = os.path.join(UPLOAD_DIR, name)
-            if os.path.isfile(path):
-                zf.write(path, arcname=name)
-    zip_buffer.seek(0)
+    def generate():
+        # ZIP 全体をメモリに溜めず、COPY_CHUNK_SIZE ごとにクライアントへ流す
+        stream = _ZipStream()
+        # WAV(PCM) はほとんど縮まないので無圧縮で格納し、それ以外は最速レベルで deflate
+        with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            for name in filenames:
+                path = os.path.join(UPLOAD_DIR, name)
+                if not os.path.isfile(path):
+                    continue
+                if not name.endswith(".wav"):
+                    zf.write(path, arcname=name)
+                    yield stream.drain()
+                    continue
+                zinfo = zipfile.ZipInfo.from_file(path, arcname=name)  # ZIP_STORED
+                with open(path, "rb") as src, zf.open(zinfo, "w") as dst:
+                    while True:
+                        chunk = src.read(COPY_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        yield stream.drain()
+                yield stream.drain()  # データディスクリプタ
+        yield stream.drain()  # セントラルディレクトリ
 
-    return send_file(
-        zip_buffer,
+    return Response(
+        generate(),
         mimetype="application/zip",
-        as_attachment=True,
-        download_name="selected_recordings.zip",
+        headers={"Content-Disposition": "attachment; filename=selected_recordings.zip"},
     )
 
 # =====================
@@ -146,9 +351,9 @@ def download_selected():
 
 @app.route("/", methods=["GET", "POST"])
 def index():
-    now = datetime.now()
-    default_start_date = now.strftime("%Y-%m-%d")
-    default_end_date   = now.strftime("%Y-%m-%d")
+    today = date.today().isoformat()  # YYYY-MM-DD
+    default_start_date = today
+    default_end_date   = today
     default_start_time = "00:00"
     default_end_time   = "23:59"
 
@@ -163,22 +368,11 @@ def index():
         end_date   = default_end_date
         end_time   = default_end_time
 
-    def parse_dt(date_str, time_str, is_end=False):
-        if not date_str:
-            return None
-        if not time_str:
-            time_str = "00:00" if not is_end else "23:59"
-        try:
-            dt = datetime.strptime(date_str + " " + time_str, "%Y-%m-%d %H:%M")
-            return dt
-        except ValueError:
-            return None
-
     start_dt = parse_dt(start_date, start_time, is_end=False)
     end_dt   = parse_dt(end_date,   end_time,   is_end=True)
 
-    items    = load_all_records()
-    filtered = filter_by_range(items, start_dt, end_dt)
+    items, dts = load_all_records()
+    filtered   = filter_by_range(items, dts, start_dt, end_dt)
 
     return render_template(
         "index.html",